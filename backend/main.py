@@ -1,23 +1,59 @@
 import os
 import math
+import asyncio
 import random
-from typing import Any, Dict, List, Optional
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 import httpx
+import numpy as np
+import orjson
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, validator
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
 # (파일 상단에)  from mangum import Mangum
 
 
 KAKAO_REST_API_KEY = os.getenv("KAKAO_REST_API_KEY", "faa3869240e454c8a6be06fbc2974992")
+KAKAO_PAGE_SIZE = 15  # Kakao keyword search max size per page
+KAKAO_MAX_PAGE = 45  # Kakao keyword search max page
+
+SEARCH_CACHE_TTL_S = 600.0
+SEARCH_CACHE_MAX_SIZE = 1024
+# (query, 반올림 경도, 반올림 위도, 반경 버킷, page_limit) -> (저장 시각, 실제 검색 좌표 (x, y), 검색 결과)
+_SEARCH_CACHE: "OrderedDict[tuple, tuple[float, tuple[float, float], List[Dict[str, Any]]]]" = OrderedDict()
+_SEARCH_CACHE_LOCK = asyncio.Lock()
+
+# 요청마다 새로 만들지 않고 앱 수명 동안 재사용하는 HTTP 클라이언트 (startup/shutdown에서 관리)
+client: Optional[httpx.AsyncClient] = None
+
+
+def _create_http_client() -> httpx.AsyncClient:
+	# HTTP/2로 페이지 동시 요청을 하나의 연결에 다중화 (httpx[http2] 필요)
+	return httpx.AsyncClient(
+		timeout=10.0,
+		http2=True,
+		limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+	)
+
+
+def get_http_client() -> httpx.AsyncClient:
+	"""Return the shared client, creating it if startup has not run (e.g. Lambda, where lifespan is off)."""
+	global client
+	if client is None or client.is_closed:
+		client = _create_http_client()
+	return client
 
 
 class Waypoint(BaseModel):
 	theme_keyword: str = Field(..., min_length=1, description="Search keyword for this waypoint")
 	order: int = Field(..., ge=1, description="Order of this waypoint in the route")
 
-	@validator("theme_keyword")
+	@field_validator("theme_keyword")
+	@classmethod
 	def strip_keyword(cls, v: str) -> str:
 		return v.strip()
 
@@ -65,6 +101,18 @@ def haversine_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
 	return R * c
 
 
+def haversine_km_array(lat1: float, lon1: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+	"""Vectorized great-circle distance (km) from one point to arrays of points."""
+	R = 6371.0
+	phi1 = math.radians(lat1)
+	phi2 = np.radians(lats)
+	# 이미 변환한 phi2를 재사용해 배열에 대한 np.radians 한 번을 줄임
+	dphi = phi2 - phi1
+	dlambda = np.radians(lons - lon1)
+	a = np.sin(dphi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+	return 2 * R * np.arcsin(np.sqrt(a))
+
+
 def calculate_destination_point(start_lat: float, start_lng: float, distance_km: float, bearing_deg: float) -> tuple[float, float]:
 	"""시작점에서 특정 거리와 방향으로 떨어진 지점의 좌표를 계산합니다."""
 	R = 6371.0  # 지구 반지름 (km)
@@ -98,13 +146,22 @@ def build_kakao_walk_url(points: List[Dict[str, str]]) -> str:
 	"""
 	# Pattern: /link/by/walk/이름,위도,경도/이름,위도,경도/...
 	# We will construct as https://map.kakao.com/link/by/walk/...
-	parts = []
-	for p in points:
-		name = p.get("name", "Point")
-		lat = p["lat"]
-		lng = p["lng"]
-		parts.append(f"{name},{lat},{lng}")
-	return "https://map.kakao.com/link/by/walk/" + "/".join(parts)
+	return "https://map.kakao.com/link/by/walk/" + "/".join(
+		f"{p.get('name', 'Point')},{p['lat']},{p['lng']}" for p in points
+	)
+
+
+def _parse_kakao_response(r: httpx.Response) -> Dict[str, Any]:
+	"""Raise HTTPException for a failed Kakao response, otherwise return its JSON body."""
+	if r.status_code != 200:
+		error_text = r.text
+		if "NotAuthorizedError" in error_text and "OPEN_MAP_AND_LOCAL" in error_text:
+			raise HTTPException(
+				status_code=403, 
+				detail="Kakao Local API service is not enabled. Please enable 'OPEN_MAP_AND_LOCAL' service in your Kakao Developers console."
+			)
+		raise HTTPException(status_code=502, detail=f"Kakao API error: {error_text}")
+	return orjson.loads(r.content)
 
 
 async def kakao_keyword_search(
@@ -113,44 +170,101 @@ async def kakao_keyword_search(
 	y: float,
 	radius_m: int,
 	page_limit: int = 30,
+	target_candidates: Optional[int] = None,
 ) -> List[Dict[str, Any]]:
 	"""Query Kakao Local Keyword Search API around a point within radius.
-	Collect multiple pages up to page_limit.
+	Results come back nearest-first, so when target_candidates is given only the
+	pages needed to cover that many places are fetched.
+	Results are cached for SEARCH_CACHE_TTL_S, keyed on a ~100m coordinate grid.
+	"""
+	results, _ = await _cached_keyword_search(query, x, y, radius_m, page_limit, target_candidates)
+	return results
+
+
+async def _cached_keyword_search(
+	query: str,
+	x: float,
+	y: float,
+	radius_m: int,
+	page_limit: int,
+	target_candidates: Optional[int],
+) -> Tuple[List[Dict[str, Any]], Tuple[float, float]]:
+	"""Same as kakao_keyword_search, but also returns the exact (x, y) the results
+	were fetched for. Each document's distance field is measured from that point,
+	which on a cache hit may differ from the requested x/y by up to ~100m.
 	"""
 	if not KAKAO_REST_API_KEY:
 		raise HTTPException(status_code=500, detail="KAKAO_REST_API_KEY is not configured")
 
+	if target_candidates is not None:
+		page_limit = min(page_limit, max(1, math.ceil(target_candidates / KAKAO_PAGE_SIZE)))
+
+	key = (query, round(x, 3), round(y, 3), radius_m // 500, page_limit)
+	async with _SEARCH_CACHE_LOCK:
+		cached = _SEARCH_CACHE.get(key)
+		if cached is not None:
+			ts, origin, results = cached
+			if time.monotonic() - ts < SEARCH_CACHE_TTL_S:
+				_SEARCH_CACHE.move_to_end(key)
+				return results, origin
+			del _SEARCH_CACHE[key]
+
+	results = await _fetch_kakao_keyword_search(query, x, y, radius_m, page_limit)
+
+	async with _SEARCH_CACHE_LOCK:
+		_SEARCH_CACHE[key] = (time.monotonic(), (x, y), results)
+		_SEARCH_CACHE.move_to_end(key)
+		while len(_SEARCH_CACHE) > SEARCH_CACHE_MAX_SIZE:
+			_SEARCH_CACHE.popitem(last=False)
+	return results, (x, y)
+
+
+async def _fetch_kakao_keyword_search(
+	query: str,
+	x: float,
+	y: float,
+	radius_m: int,
+	page_limit: int,
+) -> List[Dict[str, Any]]:
+	"""Collect multiple pages up to page_limit, fetching them concurrently."""
 	headers = {"Authorization": f"KakaoAK {KAKAO_REST_API_KEY}"}
 	url = "https://dapi.kakao.com/v2/local/search/keyword"
-	results: List[Dict[str, Any]] = []
-
-	async with httpx.AsyncClient(timeout=10.0) as client:
-		# 마지막 페이지부터 시작해서 장소들을 수집
-		params = {
-			"query": query,
-			"x": x,
-			"y": y,
-			"radius": radius_m,  # meters; Kakao supports up to 20000 for some endpoints
-			"sort": "distance",
-			"page": page_limit,  # 마지막 페이지부터 시작
-			"size": 15,
-		}
-		r = await client.get(url, headers=headers, params=params)
-		if r.status_code != 200:
-			error_text = r.text
-			if "NotAuthorizedError" in error_text and "OPEN_MAP_AND_LOCAL" in error_text:
-				raise HTTPException(
-					status_code=403, 
-					detail="Kakao Local API service is not enabled. Please enable 'OPEN_MAP_AND_LOCAL' service in your Kakao Developers console."
-				)
-			raise HTTPException(status_code=502, detail=f"Kakao API error: {error_text}")
-		data = r.json()
-		documents = data.get("documents", [])
-		results.extend(documents)
+	params = {
+		"query": query,
+		"x": x,
+		"y": y,
+		"radius": radius_m,  # meters; Kakao supports up to 20000 for some endpoints
+		"sort": "distance",
+		"size": KAKAO_PAGE_SIZE,
+	}
+
+	http_client = get_http_client()
+	# 첫 페이지로 pageable_count를 확인한 뒤 실제 마지막 페이지까지 나머지를 동시에 요청
+	first = await http_client.get(url, headers=headers, params={**params, "page": 1})
+	data = _parse_kakao_response(first)
+	results: List[Dict[str, Any]] = list(data.get("documents", []))
+	meta = data.get("meta", {})
+	if meta.get("is_end", True):
+		return results
+
+	pageable_count = int(meta.get("pageable_count") or 0)
+	last_page = min(page_limit, KAKAO_MAX_PAGE, math.ceil(pageable_count / KAKAO_PAGE_SIZE))
+	if last_page < 2:
+		return results
+
+	tasks = [http_client.get(url, headers=headers, params={**params, "page": page}) for page in range(2, last_page + 1)]
+	responses = await asyncio.gather(*tasks)
+
+	# 페이지 순서대로 이어붙이고, is_end 이후의 페이지는 버림
+	for r in responses:
+		data = _parse_kakao_response(r)
+		results.extend(data.get("documents", []))
+		if data.get("meta", {}).get("is_end", True):
+			break
 	return results
 
 
-app = FastAPI(title="Running Route Recommender")
+app = FastAPI(title="Running Route Recommender", default_response_class=ORJSONResponse)
 
 app.add_middleware(
 	CORSMiddleware,
@@ -161,6 +275,20 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def startup() -> None:
+	global client
+	client = _create_http_client()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+	global client
+	if client is not None:
+		await client.aclose()
+		client = None
+
+
 @app.get("/health")
 async def health() -> Dict[str, str]:
 	return {"status": "ok"}
@@ -170,28 +298,67 @@ async def find_waypoint_places(
 	keyword: str,
 	center_lat: float,
 	center_lng: float,
-	search_radius_m: int = 2000
-) -> List[Dict[str, Any]]:
-	"""경유지 주변에서 키워드로 장소를 검색합니다."""
-	places = await kakao_keyword_search(keyword, x=center_lng, y=center_lat, radius_m=search_radius_m, page_limit=30)
+	search_radius_m: int = 2000,
+	top_k: int = 10,
+) -> Tuple[List[Dict[str, Any]], int]:
+	"""경유지 주변에서 키워드로 장소를 검색합니다.
+	중심점에서 가까운 상위 top_k개 장소(거리순)와 검토한 후보 수를 반환합니다.
+	"""
+	places, origin = await _cached_keyword_search(keyword, center_lng, center_lat, search_radius_m, 30, top_k)
+	# distance 필드는 캐시를 채운 요청의 좌표 기준이므로, 중심점과 정확히 같을 때만 신뢰.
+	# 캐시 적중으로 좌표가 다르면 모든 장소를 중심점 기준 haversine으로 계산해 기준점을 통일한다.
+	trust_distance = origin == (center_lng, center_lat)
 	
-	# 장소들을 중심점에서의 거리로 계산
-	scored: List[Dict[str, Any]] = []
+	# 좌표를 파싱할 수 없는 장소는 제외
+	valid: List[Dict[str, Any]] = []
+	d_kms: List[float] = []
+	# distance 필드가 없는 장소의 (valid 내 위치, 위도, 경도)만 따로 모음
+	missing_idx: List[int] = []
+	missing_lats: List[float] = []
+	missing_lngs: List[float] = []
 	for p in places:
 		try:
 			lat = float(p["y"])
 			lng = float(p["x"])
 		except Exception:
 			continue
-		
-		d_km = haversine_km(center_lat, center_lng, lat, lng)
-		p_copy = dict(p)
-		p_copy["distance_km"] = d_km
-		scored.append(p_copy)
+		# x, y를 주면 Kakao가 검색 좌표로부터의 거리(m)를 distance 필드로 돌려줌
+		d_m = 0
+		if trust_distance:
+			try:
+				d_m = int(p.get("distance") or 0)
+			except ValueError:
+				pass
+		if d_m <= 0:
+			missing_idx.append(len(valid))
+			missing_lats.append(lat)
+			missing_lngs.append(lng)
+		valid.append(p)
+		d_kms.append(d_m / 1000.0)
+	
+	if not valid:
+		return [], 0
 	
-	# 거리순으로 정렬
-	scored.sort(key=lambda x: x["distance_km"])
-	return scored
+	# distance 필드가 없거나 신뢰할 수 없는 장소만 haversine으로 계산
+	d_km = np.array(d_kms, dtype=np.float64)
+	if missing_idx:
+		d_km[missing_idx] = haversine_km_array(
+			center_lat,
+			center_lng,
+			np.array(missing_lats, dtype=np.float64),
+			np.array(missing_lngs, dtype=np.float64),
+		)
+	
+	# 전체 정렬 대신 가까운 top_k개만 골라서 정렬
+	k = min(top_k, len(valid))
+	if k < len(valid):
+		idx = np.argpartition(d_km, k - 1)[:k]
+		idx = idx[np.argsort(d_km[idx], kind="stable")]
+	else:
+		idx = np.argsort(d_km, kind="stable")
+	
+	# 검색 결과는 캐시와 공유되므로 복사/수정하지 않고 원본 문서를 그대로 반환
+	return [valid[i] for i in idx], len(valid)
 
 
 def distribute_distance_for_waypoints(total_distance_km: float, waypoint_count: int, is_round_trip: bool) -> List[float]:
@@ -220,6 +387,8 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 	total_distance_km = req.total_distance_km
 	waypoints = req.waypoints
 	is_round_trip = req.is_round_trip
+	# 시작점 좌표 문자열은 요청당 한 번만 만든다
+	start_point = {"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"}
 	
 	# 경유지가 없는 경우 기본 동작 (단일 목적지)
 	if not waypoints:
@@ -227,23 +396,25 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 		random_bearing = random.uniform(0, 360)
 		target_lat, target_lng = calculate_destination_point(start_lat, start_lng, total_distance_km, random_bearing)
 		
-		places = await kakao_keyword_search("카페", x=target_lng, y=target_lat, radius_m=1000, page_limit=30)
+		# 가장 가까운 장소 하나만 쓰므로 첫 페이지면 충분
+		places = await kakao_keyword_search("카페", x=target_lng, y=target_lat, radius_m=1000, page_limit=30, target_candidates=KAKAO_PAGE_SIZE)
 		
 		if not places:
-			route_url = build_kakao_walk_url([{"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"}])
+			route_url = build_kakao_walk_url([start_point])
 			return RecommendResponse(waypoints=[], route_url=route_url, total_distance_km=total_distance_km, actual_total_distance_km=0, is_round_trip=is_round_trip, candidates_considered=0)
 		
 		# 첫 번째 장소 선택
 		selected = places[0]
 		dest_name = selected.get("place_name") or "Destination"
-		dest_lat = f"{selected['y']}"
-		dest_lng = f"{selected['x']}"
+		# Kakao가 좌표를 이미 문자열로 돌려주므로 그대로 사용
+		dest_lat = selected["y"]
+		dest_lng = selected["x"]
 		
-		route_points = [{"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"}]
+		route_points = [start_point]
 		route_points.append({"name": dest_name, "lat": dest_lat, "lng": dest_lng})
 		
 		if is_round_trip:
-			route_points.append({"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"})
+			route_points.append(start_point)
 		
 		route_url = build_kakao_walk_url(route_points)
 		
@@ -280,7 +451,7 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 	segment_distances = distribute_distance_for_waypoints(total_distance_km, waypoint_count, is_round_trip)
 	
 	waypoint_results = []
-	route_points = [{"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"}]
+	route_points = [start_point]
 	current_lat, current_lng = start_lat, start_lng
 	total_candidates = 0
 	
@@ -294,7 +465,7 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 		target_lat, target_lng = calculate_destination_point(current_lat, current_lng, segment_distance, random_bearing)
 		
 		# 해당 지점 주변에서 키워드로 장소 검색
-		places = await find_waypoint_places(waypoint.theme_keyword, target_lat, target_lng, 1000)
+		places, candidates_considered = await find_waypoint_places(waypoint.theme_keyword, target_lat, target_lng, 1000)
 		
 		if not places:
 			# 장소를 찾지 못한 경우 기본 목적지 생성
@@ -312,7 +483,7 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 			# 첫 번째 장소 선택 (가장 가까운 장소)
 			selected = places[0]
 		
-		total_candidates += len(places)
+		total_candidates += candidates_considered
 		
 		# 결과 저장
 		waypoint_result = WaypointResult(
@@ -343,7 +514,7 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 	
 	# 왕복일 경우 시작점으로 돌아가는 경로 추가
 	if is_round_trip:
-		route_points.append({"name": "Start", "lat": f"{start_lat}", "lng": f"{start_lng}"})
+		route_points.append(start_point)
 	
 	route_url = build_kakao_walk_url(route_points)
 	
@@ -376,9 +547,19 @@ async def recommend(req: RecommendRequest) -> RecommendResponse:
 if __name__ == "__main__":
 	import uvicorn
 
-	uvicorn.run("main:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")), reload=True)
+	# uvloop/httptools는 uvicorn[standard]에 포함되어 있지만 Windows에서는 uvloop를 쓸 수 없음
+	uvicorn.run(
+		"main:app",
+		host="0.0.0.0",
+		port=int(os.getenv("PORT", "8000")),
+		loop="asyncio" if sys.platform == "win32" else "uvloop",
+		http="httptools",
+		reload=True,
+	)
 
 from mangum import Mangum
 
 # FastAPI app = FastAPI(...) 이미 있음
-handler = Mangum(app)  # <-- Lambda 엔트리포인트
\ No newline at end of file
+# lifespan="auto"면 Mangum이 호출마다 startup/shutdown을 돌려 공유 HTTP 클라이언트를 매번 닫아버림.
+# 끄고 get_http_client()가 lazy하게 만든 클라이언트를 warm 호출 간에 재사용한다.
+handler = Mangum(app, lifespan="off")  # <-- Lambda 엔트리포인트
\ No newline at end of file